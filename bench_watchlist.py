@@ -0,0 +1,274 @@
+"""主要页面的性能基准测试
+
+在临时的 SQLite 数据库文件里生成指定数量的电影记录，通过 app.test_client() 在进程内发送请求，
+统计每个路由的吞吐量、p50 / p99 延迟和每个请求执行的 SQL 语句数量。
+
+    python bench_watchlist.py --size 10000
+    python bench_watchlist.py --size 1000000 --requests 500 --concurrency 4
+
+每个场景使用固定种子（--seed）的随机数生成请求的电影 id，所以每次运行的请求完全相同。
+基准文件（默认 bench_baseline.json）只保存每个场景平均每个请求的 SQL 语句数量，这和机器无关；
+SQL 语句数量和基准文件中相同数据规模的记录不同、基准文件中没有相同数据规模的记录，或者出现错误响应时，以状态码 1 退出。
+延迟和吞吐量取决于机器和负载，默认只输出不比较。需要比较时先在同一台机器上用修改前的版本运行
+--timing-baseline FILE --update-baseline 记录，再用修改后的版本运行 --timing-baseline FILE，
+p50 / p99 延迟变长或吞吐量下降超过 --tolerance（默认 20%）时同样以状态码 1 退出。
+使用 --update-baseline 把本次结果写入基准文件。
+"""
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from sqlalchemy import event
+
+from app import app, db, User, forge, import_movies
+
+USERNAME = 'bench'
+PASSWORD = 'bench-password'
+
+
+def seed(size):
+    """创建用户和 size 条电影记录，返回 (秒数, 记录数)"""
+    db.create_all()
+    user = User(name='Bench', username=USERNAME)
+    user.set_password(PASSWORD)
+    db.session.add(user)
+    db.session.commit()
+
+    rows = ({'title': 'Movie %d' % i, 'year': 1900 + i % 125} for i in range(size))
+    start = time.perf_counter()
+    imported, _ = import_movies(rows, batch_size=10000, user_id=user.id)
+    return time.perf_counter() - start, imported
+
+
+class QueryCounter:
+    # 统计当前线程执行的 SQL 语句数量
+    def __init__(self):
+        self.local = threading.local()
+        event.listen(db.engine, 'before_cursor_execute', self.count)
+
+    def count(self, *args):
+        self.local.count = getattr(self.local, 'count', 0) + 1
+
+    def reset(self):
+        self.local.count = 0
+
+    @property
+    def value(self):
+        return getattr(self.local, 'count', 0)
+
+
+def login(client):
+    client.post('/login', data={'username': USERNAME, 'password': PASSWORD})
+
+
+def scenarios(size):
+    # 每一项是 (名称, 是否需要登录, 发送一个请求的函数)，函数接受客户端和随机数生成器，返回响应状态码
+    def random_id(rng):
+        return rng.randint(1, size)
+
+    return [
+        ('index', False, lambda client, rng: client.get('/').status_code),
+        ('index_uncached', False, lambda client, rng: (app.extensions['page_cache'].clear(), client.get('/').status_code)[1]),
+        ('index_deep_page', False, lambda client, rng: client.get('/?after=%d' % random_id(rng)).status_code),
+        ('index_authenticated', True, lambda client, rng: client.get('/?after=%d' % random_id(rng)).status_code),
+        ('search', False, lambda client, rng: client.get('/search?q=movie+%d' % random_id(rng)).status_code),
+        ('api_movies', False, lambda client, rng: client.get('/api/movies?after=%d' % random_id(rng)).status_code),
+        ('edit_get', True, lambda client, rng: client.get('/movie/edit/%d' % random_id(rng)).status_code),
+        ('edit_post', True, lambda client, rng: client.post(
+            '/movie/edit/%d' % random_id(rng), data={'title': 'Edited %d' % random_id(rng), 'year': '2000'}).status_code),
+        ('login', False, lambda client, rng: client.post(
+            '/login', data={'username': USERNAME, 'password': PASSWORD}).status_code),
+    ]
+
+
+def run_scenario(name, func, needs_login, requests, concurrency, counter, seed):
+    latencies = []
+    queries = []
+    errors = []
+    lock = threading.Lock()
+
+    def worker(index, count):
+        client = app.test_client()  # 每个线程使用自己的客户端（独立的 Cookie）
+        rng = random.Random('%s-%s-%d' % (seed, name, index))  # 每个场景、每个线程的请求序列都是固定的
+        if needs_login:
+            login(client)
+        for _ in range(count):
+            counter.reset()
+            start = time.perf_counter()
+            status = func(client, rng)
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                queries.append(counter.value)
+                if status >= 400:
+                    errors.append(status)
+
+    per_worker = [requests // concurrency + (1 if i < requests % concurrency else 0) for i in range(concurrency)]
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(worker, range(concurrency), per_worker))
+    wall = time.perf_counter() - start
+    return summarize(latencies, queries, errors, wall)
+
+
+def summarize(latencies, queries, errors, wall):
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'rps': len(latencies) / wall if wall else 0.0,
+        'p50_ms': percentile(latencies, 50) * 1000,
+        'p99_ms': percentile(latencies, 99) * 1000,
+        'queries': sum(queries) / len(queries) if queries else 0.0,
+        'errors': len(errors),
+    }
+
+
+def percentile(values, pct):
+    # 最近秩法，values 需要已经排好序
+    if not values:
+        return 0.0
+    rank = max(int(round(pct / 100.0 * len(values) + 0.5)) - 1, 0)
+    return values[min(rank, len(values) - 1)]
+
+
+def bench_forge(iterations, counter):
+    runner = app.test_cli_runner()
+    latencies = []
+    queries = []
+    start = time.perf_counter()
+    for _ in range(iterations):
+        counter.reset()
+        t = time.perf_counter()
+        runner.invoke(forge)
+        latencies.append(time.perf_counter() - t)
+        queries.append(counter.value)
+    return summarize(latencies, queries, [], time.perf_counter() - start)
+
+
+def compare(results, baseline):
+    """返回和基准不同的项目列表：SQL 语句数量变化（请求序列固定，所以应该完全相同）或者出现错误响应"""
+    regressions = []
+    for name, result in results.items():
+        if result['errors']:
+            regressions.append('%s: %d error responses' % (name, result['errors']))
+        expected = baseline.get(name)
+        if expected is None:
+            regressions.append('%s: no baseline' % name)
+            continue
+        if abs(result['queries'] - expected['queries']) > 1e-6:
+            regressions.append('%s: %.3f queries/request != baseline %.3f' % (name, result['queries'], expected['queries']))
+    return regressions
+
+
+def compare_timings(results, baseline, tolerance):
+    """返回延迟或吞吐量比同一台机器上记录的基准差 tolerance（比例）以上的项目列表"""
+    regressions = []
+    for name, result in results.items():
+        expected = baseline.get(name)
+        if expected is None:
+            regressions.append('%s: no timing baseline' % name)
+            continue
+        for field in ('p50_ms', 'p99_ms'):
+            if result[field] > expected[field] * (1 + tolerance):
+                regressions.append('%s: %s %.2f > baseline %.2f' % (name, field, result[field], expected[field]))
+        if result['rps'] * (1 + tolerance) < expected['rps']:
+            regressions.append('%s: %.1f req/s < baseline %.1f' % (name, result['rps'], expected['rps']))
+    return regressions
+
+
+def load_baselines(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def save_baselines(path, baselines):
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(baselines, f, indent=2, sort_keys=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the watchlist hot paths.')
+    parser.add_argument('--size', type=int, default=10000, help='Number of movies to seed.')
+    parser.add_argument('--requests', type=int, default=200, help='Requests per route.')
+    parser.add_argument('--concurrency', type=int, default=1, help='Concurrent in-process clients.')
+    parser.add_argument('--forge', type=int, default=5, help='Number of times to run the forge command.')
+    parser.add_argument('--only', action='append', help='Only run the given route (repeatable).')
+    parser.add_argument('--baseline', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'bench_baseline.json'))
+    parser.add_argument('--update-baseline', action='store_true', help='Store these results as the new baseline.')
+    parser.add_argument('--seed', default='watchlist', help='Seed for the movie ids requested by each scenario.')
+    parser.add_argument('--timing-baseline', help='Also compare latency and throughput with timings recorded in this file '
+                        '(on the same machine).')
+    parser.add_argument('--tolerance', type=float, default=20, help='Allowed timing regression in percent.')
+    args = parser.parse_args(argv)
+
+    tmpdir = tempfile.mkdtemp(prefix='watchlist-bench-')
+    app.config.update(
+        SQLALCHEMY_DATABASE_URI='sqlite:///' + os.path.join(tmpdir, 'bench.db'),
+        SLOW_REQUEST_THRESHOLD=None,
+        ADMISSION_CONTROL=False,  # 基准测试从同一个地址发出大量请求，不限速
+    )
+    try:
+        with app.app_context():
+            counter = QueryCounter()
+            counter.reset()
+            seconds, imported = seed(args.size)
+            results = {'import': summarize([seconds], [counter.value], [], seconds)}
+            results['import']['rps'] = imported / seconds if seconds else 0.0
+            for name, needs_login, func in scenarios(args.size):
+                if args.only and name not in args.only:
+                    continue
+                results[name] = run_scenario(name, func, needs_login, args.requests, args.concurrency, counter, args.seed)
+            if args.forge and (not args.only or 'forge' in args.only):
+                results['forge'] = bench_forge(args.forge, counter)
+            db.session.remove()
+            db.engine.dispose()
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    print('%-22s %9s %10s %9s %9s %9s %7s' % ('route', 'requests', 'req/s', 'p50 ms', 'p99 ms', 'queries', 'errors'))
+    for name, r in results.items():
+        print('%-22s %9d %10.1f %9.2f %9.2f %9.2f %7d' % (
+            name, r['requests'], r['rps'], r['p50_ms'], r['p99_ms'], r['queries'], r['errors']))
+
+    baselines = load_baselines(args.baseline)
+    timings = load_baselines(args.timing_baseline) if args.timing_baseline else {}
+    # 基准按数据规模、每个场景的请求数和并发数区分，这些参数不同时请求序列也不同
+    key = '%d/%d/%d' % (args.size, args.requests, args.concurrency)
+    if args.update_baseline:
+        baselines[key] = {name: {'queries': round(r['queries'], 6)} for name, r in results.items()}
+        save_baselines(args.baseline, baselines)
+        print('Baseline for %s (movies/requests/concurrency) written to %s.' % (key, args.baseline))
+        if args.timing_baseline:
+            timings[key] = {name: {field: round(r[field], 3) for field in ('rps', 'p50_ms', 'p99_ms')}
+                            for name, r in results.items()}
+            save_baselines(args.timing_baseline, timings)
+            print('Timings for %s written to %s.' % (key, args.timing_baseline))
+        return 0
+
+    if key not in baselines:
+        # 没有可比较的基准时不能当作通过，否则换一个参数运行就会跳过全部检查
+        print('ERROR no baseline for %s (movies/requests/concurrency) in %s, run with --update-baseline first.'
+              % (key, args.baseline))
+        return 1
+    regressions = compare(results, baselines[key])
+    if args.timing_baseline:
+        if key not in timings:
+            print('ERROR no timings for %s (movies/requests/concurrency) in %s, run with --update-baseline first.'
+                  % (key, args.timing_baseline))
+            return 1
+        regressions += compare_timings(results, timings[key], args.tolerance / 100.0)
+    for line in regressions:
+        print('REGRESSION ' + line)
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,7 +1,27 @@
+import os
+import re
+import sqlite3
+import io
+import gzip
+import json
+import shutil
+import tempfile
+import threading
+import time
 import unittest
+import zlib
 
 # 导入命令函数
-from app import app, db, Movie, User, forge, initdb
+from unittest import mock
+
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+from werkzeug.security import generate_password_hash
+from werkzeug.test import Client
+
+from app import app, create_app, db, Movie, User, forge, initdb, page_cache, user_cache, PasswordHasher, WriteQueue, \
+    write_watchlist, JOB_KINDS, ImdbIndex, CompressionMiddleware, Job, JobRunner, current_worker, \
+    get_schema_revision, run_migrations, search_movies, movie_stats, SCHEMA_REVISION
 
 class WatchlistTestCase(unittest.TestCase):
 
@@ -14,15 +34,22 @@ class WatchlistTestCase(unittest.TestCase):
             # 这会使用 SQLite 内存型数据库，不会干扰开发时使用的数据库文件
             # 也可以使用不同文件名的 SQLite 数据库文件，但内存型数据库速度更快
         )
+        # 数据库、缓存等扩展都通过 init_app() 绑定到程序实例，使用前需要推送程序上下文
+        self.context = app.app_context()
+        self.context.push()
         # 创建数据库和表
         db.create_all()
         # 创建测试数据，一个用户，一个电影条目
         user = User(name='Test', username='test')
         user.set_password('123')
-        movie = Movie(title='Test Movie Title', year='2019')
-        # 使用 add_all() 方法一次添加多个模型类实例，传入列表
-        db.session.add_all([user, movie])
+        db.session.add(user)
+        db.session.flush()  # 生成 user.id，电影条目属于这个用户
+        movie = Movie(title='Test Movie Title', year='2019', user_id=user.id)
+        db.session.add(movie)
         db.session.commit()
+        page_cache.clear()  # 清除上一个测试缓存的页面和用户信息
+        user_cache.clear()
+        app.extensions['rate_limiter'].clear()  # 各个测试的请求都来自同一个地址，不累计限速
 
         self.client = app.test_client()  # 创建测试客户端，用来模拟客户端请求
         self.runner = app.test_cli_runner()  # 创建测试命令运行器，用来触发自定义命令
@@ -30,6 +57,7 @@ class WatchlistTestCase(unittest.TestCase):
     def tearDown(self):
         db.session.remove()  # 清除数据库会话
         db.drop_all()  # 删除数据库表，测试时的程序状态和真实的程序运行状态不同，所以需要调用 db.session.remove() 来确保数据库会话被清除。
+        self.context.pop()
 
     # 测试程序实例是否存在
     def test_app_exist(self):
@@ -40,6 +68,103 @@ class WatchlistTestCase(unittest.TestCase):
         self.assertTrue(app.config['TESTING'])
 
 
+    # 测试 SQLite 数据库文件的连接设置
+    def test_sqlite_engine_profile(self):
+        other = self.file_app(create=False, DATABASE_POOL_SIZE=2)
+        engine = db.get_engine(other)
+
+        self.assertIsInstance(engine.pool, QueuePool)
+        self.assertEqual(engine.pool.size(), 2)
+        with engine.connect() as conn:
+            self.assertEqual(conn.execute('PRAGMA journal_mode').scalar(), 'wal')
+            self.assertEqual(conn.execute('PRAGMA busy_timeout').scalar(), 5000)
+            self.assertEqual(conn.execute('PRAGMA synchronous').scalar(), 1)  # NORMAL
+            self.assertEqual(conn.execute('PRAGMA cache_size').scalar(), -64000)
+
+    # 测试工厂函数按各自的配置创建相互独立的程序实例
+    def test_create_app(self):
+        other = self.file_app(create=False, PAGE_CACHE_SIZE=8, PRELOAD=True)
+        self.assertIsNot(other.extensions['page_cache'], app.extensions['page_cache'])
+        self.assertEqual(other.extensions['page_cache'].maxsize, 8)
+        self.assertEqual(page_cache.maxsize, app.config['PAGE_CACHE_SIZE'])
+        # 预加载模式下模板已经编译好
+        self.assertIn('index.html', [key[1] for key in other.jinja_env.cache.keys()])
+
+        with other.app_context():
+            db.create_all()
+            db.session.add(Movie(title='Other Movie', year=2000))
+            db.session.commit()
+        response = other.test_client().get('/')
+        self.assertIn('Other Movie', response.get_data(as_text=True))
+        self.assertNotIn('Test Movie Title', response.get_data(as_text=True))
+        self.assertEqual(Movie.query.count(), 1)  # 默认程序实例的数据库不受影响
+
+    # 测试预编译模板，之后新的程序实例直接加载字节码缓存
+    def test_compile_templates_command(self):
+        tmpdir = self.make_tmpdir()
+        other = create_app({'TEMPLATE_CACHE_DIR': tmpdir})
+        result = other.test_cli_runner().invoke(args=['compile-templates'])
+        self.assertIn('Compiled 8 templates into %s.' % tmpdir, result.output)
+        self.assertEqual(len(os.listdir(tmpdir)), 8)
+
+        fresh = create_app({'TEMPLATE_CACHE_DIR': tmpdir})
+        with mock.patch.object(fresh.jinja_env, 'compile', side_effect=AssertionError('template compiled')):
+            with fresh.app_context():
+                fresh.jinja_env.get_template('index.html')
+
+        # 默认不使用字节码缓存；缓存目录无法创建时同样不使用，而不是无法启动
+        self.assertIsNone(app.jinja_env.bytecode_cache)
+        path = os.path.join(tmpdir, 'file')
+        open(path, 'w').close()
+        with self.assertLogs(level='WARNING'):
+            broken = create_app({'TEMPLATE_CACHE_DIR': os.path.join(path, 'cache')})
+        self.assertIsNone(broken.jinja_env.bytecode_cache)
+        with broken.app_context():
+            broken.jinja_env.get_template('index.html')
+
+    # 测试升级旧版本的数据库
+    def test_migrate(self):
+        # 新建的数据库已经是最新版本
+        result = self.runner.invoke(args=['migrate'])
+        self.assertIn('Database is at revision %d.' % SCHEMA_REVISION, result.output)
+        self.assertNotIn('Applying', result.output)
+
+        tmpdir = self.make_tmpdir()
+        path = os.path.join(tmpdir, 'data.db')
+        conn = sqlite3.connect(path)
+        conn.executescript('''
+            CREATE TABLE user (id INTEGER PRIMARY KEY, name VARCHAR(20), username VARCHAR(20), password_hash VARCHAR(128));
+            CREATE TABLE movie (id INTEGER PRIMARY KEY, title VARCHAR(60), year VARCHAR(4));
+            INSERT INTO user (name, username) VALUES ('Grey Li', 'grey');
+            INSERT INTO movie (title, year) VALUES ('Leon', '1994'), ('WALL-E', '2008'), ('Mahjong', ' 1996'), ('Bad', 'abc');
+        ''')
+        conn.close()
+
+        other = self.file_app(path, create=False)
+        with other.app_context():
+            messages = []
+            self.assertEqual(get_schema_revision(), 0)
+            self.assertEqual(run_migrations(batch_size=3, echo=messages.append), SCHEMA_REVISION)
+            self.assertIn('  copied 4 movies', messages)
+            self.assertEqual([(m.title, m.year) for m in Movie.query.order_by(Movie.id)],
+                             [('Leon', 1994), ('WALL-E', 2008), ('Mahjong', 1996), ('Bad', None)])
+            self.assertEqual(Movie.query.filter(Movie.year > 2000).count(), 1)
+            self.assertEqual(search_movies('mah')[0].title, 'Mahjong')
+            indexes = [row[1] for row in db.session.execute('PRAGMA index_list(movie)')]
+            self.assertIn('ix_movie_year', indexes)
+            self.assertIn('ix_movie_title_year', indexes)
+            self.assertIn('ix_user_username', [row[1] for row in db.session.execute('PRAGMA index_list(user)')])
+            self.assertEqual(Movie.query.filter_by(user_id=1).count(), 4)  # 已有的电影属于第一个用户
+            self.assertIn('ix_movie_user_id_id', indexes)
+            self.assertEqual(movie_stats(1)['decades'], [(1990, 2), (2000, 1)])
+            self.assertEqual(movie_stats(1)['unknown'], 1)
+            self.assertIn('imdb_id', [row[1] for row in db.session.execute('PRAGMA table_info(movie)')])
+            # 已经是最新版本时不做任何事
+            messages = []
+            self.assertEqual(run_migrations(echo=messages.append), SCHEMA_REVISION)
+            self.assertEqual(messages, [])
+            db.session.remove()
+
     #### 测试客户端
     # 测试 404 页面
     def test_404_page(self):
@@ -57,6 +182,701 @@ class WatchlistTestCase(unittest.TestCase):
         self.assertIn('Test Movie Title', data)
         self.assertEqual(response.status_code, 200)
 
+    # 测试主页分页
+    def test_index_pagination(self):
+        db.session.add_all([Movie(title='Movie %d' % i, year='2000', user_id=1) for i in range(2, 6)])
+        db.session.commit()
+
+        response = self.client.get('/?per_page=2')
+        data = response.get_data(as_text=True)
+        self.assertIn('5 Titles', data)
+        self.assertIn('Test Movie Title', data)
+        self.assertIn('Movie 2', data)
+        self.assertNotIn('Movie 3', data)
+        self.assertIn('/?after=2&amp;per_page=2', data)
+        self.assertNotIn('Prev', data)
+
+        response = self.client.get('/?after=2&per_page=2')
+        data = response.get_data(as_text=True)
+        self.assertIn('Movie 3', data)
+        self.assertIn('Movie 4', data)
+        self.assertNotIn('Movie 2', data)
+        self.assertIn('/?before=3&amp;per_page=2', data)
+        self.assertIn('/?after=4&amp;per_page=2', data)
+
+        response = self.client.get('/?before=3&per_page=2')
+        data = response.get_data(as_text=True)
+        self.assertIn('Test Movie Title', data)
+        self.assertIn('Movie 2', data)
+        self.assertNotIn('Prev', data)
+
+        response = self.client.get('/?after=4&per_page=2')
+        data = response.get_data(as_text=True)
+        self.assertIn('Movie 5', data)
+        self.assertNotIn('Next', data)
+
+        # 超出 64 位整数范围的游标按范围的边界处理
+        response = self.client.get('/?after=%d' % 2 ** 70)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn('Movie 5', response.get_data(as_text=True))
+        data = self.client.get('/?before=%d&per_page=2' % 2 ** 70).get_data(as_text=True)
+        self.assertIn('Movie 4', data)
+        self.assertIn('Movie 5', data)
+        data = self.client.get('/api/movies?after=-%d' % 2 ** 70).get_json()
+        self.assertEqual(data['movies'][0]['title'], 'Test Movie Title')
+        self.assertEqual(data['total'], 5)
+
+    # 测试不分页显示全部电影（流式渲染）
+    def test_index_all(self):
+        db.session.add_all([Movie(title='Movie %d' % i, year='2000', user_id=1) for i in range(2, 6)])
+        db.session.commit()
+
+        response = self.client.get('/?per_page=2')
+        self.assertIn('/?all=1', response.get_data(as_text=True))
+
+        response = self.client.get('/?all=1')
+        self.assertTrue(response.is_streamed)
+        data = response.get_data(as_text=True)
+        self.assertIn('5 Titles', data)
+        for title in ['Test Movie Title', 'Movie 2', 'Movie 5']:
+            self.assertIn(title, data)
+        self.assertNotIn('Next', data)
+
+        response = self.client.get('/?all=1', headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+    # 测试响应压缩
+    def test_compression(self):
+        db.session.add_all([Movie(title='Movie %d' % i, year='2000', user_id=1) for i in range(2, 50)])
+        db.session.commit()
+
+        response = self.client.get('/?all=1', headers={'Accept-Encoding': 'gzip, deflate'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+        self.assertNotIn('Content-Length', response.headers)
+        self.assertIn('Movie 49', gzip.decompress(response.get_data()).decode())
+
+        response = self.client.get('/', headers={'Accept-Encoding': 'gzip;q=0, deflate'})
+        self.assertEqual(response.headers['Content-Encoding'], 'deflate')
+        self.assertIn('Test Movie Title', zlib.decompress(response.get_data()).decode())
+
+        # 不支持压缩的客户端、太小的响应不压缩
+        response = self.client.get('/')
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertIn('Test Movie Title', response.get_data(as_text=True))
+        response = self.client.get('/api/movies?per_page=1', headers={'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.json['movies'][0]['title'], 'Test Movie Title')
+
+    # 测试范围请求和强 ETag 的压缩
+    def test_compression_range(self):
+        # 范围请求返回的是未压缩文件中的一段，不能再压缩
+        response = self.client.get('/static/style.css', headers={'Accept-Encoding': 'gzip', 'Range': 'bytes=100-199'})
+        self.assertEqual(response.status_code, 206)
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(len(response.get_data()), 100)
+        response.close()
+
+        def wsgi_app(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'text/plain'), ('ETag', '"abc"')])
+            return [b'x' * 1000]
+        client = Client(CompressionMiddleware(wsgi_app, app.config))
+        response = client.get('/', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.headers['ETag'], 'W/"abc"')
+        self.assertEqual(gzip.decompress(response.get_data()), b'x' * 1000)
+
+    # 测试主页缓存
+    def test_index_page_cache(self):
+        self.client.get('/')
+        hits = page_cache.hits
+        # 直接修改数据库不会让缓存失效，所以仍然返回缓存的页面
+        db.session.add(Movie(title='Hidden Movie', year='2020', user_id=1))
+        db.session.commit()
+        response = self.client.get('/')
+        self.assertEqual(page_cache.hits, hits + 1)
+        self.assertNotIn('Hidden Movie', response.get_data(as_text=True))
+
+        # 登录后使用单独的缓存
+        self.login()
+        response = self.client.get('/')
+        data = response.get_data(as_text=True)
+        self.assertIn('Hidden Movie', data)
+        self.assertIn('Logout', data)
+
+        # 通过视图创建条目后缓存失效
+        self.client.post('/', data=dict(title='New Movie', year='2019'))
+        self.client.get('/logout')
+        response = self.client.get('/')
+        data = response.get_data(as_text=True)
+        self.assertIn('New Movie', data)
+        self.assertNotIn('Logout', data)
+
+    # 测试多个进程共用数据库文件时的主页缓存
+    def test_index_page_cache_other_process(self):
+        path = os.path.join(self.make_tmpdir(), 'data.db')
+        first, second = self.file_app(path), self.file_app(path, create=False)  # 模拟两个工作进程
+
+        client = second.test_client()
+        response = client.get('/')
+        etag = response.headers['ETag']
+        self.assertNotIn('Other Movie', response.get_data(as_text=True))
+        self.assertEqual(client.get('/', headers={'If-None-Match': etag}).status_code, 304)
+
+        writer = first.test_client()
+        writer.post('/login', data=dict(username='test', password='123'))
+        writer.post('/', data=dict(title='Other Movie', year='2020'))
+        writer.post('/setting', data=dict(name='Renamed'))
+
+        self.assertEqual(client.get('/', headers={'If-None-Match': etag}).status_code, 200)
+        data = client.get('/').get_data(as_text=True)
+        self.assertIn('Other Movie', data)
+        self.assertIn('Renamed', data)  # 用户信息缓存同样失效
+
+    # 测试用户信息缓存
+    def test_user_cache(self):
+        self.login()
+        self.client.get('/?per_page=3')
+
+        statements = self.record_sql()
+
+        # 换一个查询参数，绕过主页缓存
+        response = self.client.get('/?per_page=4')
+        self.assertIn('Logout', response.get_data(as_text=True))
+        self.client.get('/nothing')
+        self.assertFalse([sql for sql in statements if 'FROM user' in sql])
+
+        # 修改名字后缓存失效
+        self.client.post('/setting', data=dict(name='Grey Li'))
+        response = self.client.get('/?per_page=5')
+        self.assertIn('Grey Li', response.get_data(as_text=True))
+        self.assertEqual(User.query.first().name, 'Grey Li')
+
+    # 测试搜索
+    def test_search(self):
+        db.session.add_all([
+            Movie(title='My Neighbor Totoro', year='1988', user_id=1),
+            Movie(title='Grave of the Fireflies', year='1988', user_id=1),
+        ])
+        db.session.commit()
+
+        response = self.client.get('/search?q=Toto')
+        data = response.get_data(as_text=True)
+        self.assertIn('1 Results', data)
+        self.assertIn('My Neighbor Totoro', data)
+        self.assertNotIn('Fireflies', data)
+
+        response = self.client.get('/search?q=the+fire&format=json')
+        self.assertEqual(response.get_json()['results'], [
+            {'id': 3, 'title': 'Grave of the Fireflies', 'year': 1988}
+        ])
+
+        # 中文标题中间没有空格，同样可以搜索标题中的任意片段，包括只有两个字的词
+        db.session.add(Movie(title='我的邻居龙猫', year='1988', user_id=1))
+        db.session.commit()
+        for q in ('龙猫', '邻居龙猫', '邻居龙 猫'):
+            results = self.client.get('/search', query_string={'q': q, 'format': 'json'}).get_json()['results']
+            self.assertEqual([movie['title'] for movie in results], ['我的邻居龙猫'])
+        self.assertEqual(self.client.get('/search', query_string={'q': '龙猫 fire', 'format': 'json'}).get_json()['results'], [])
+
+        # 编辑和删除后索引同步更新
+        self.login()
+        self.client.post('/movie/edit/2', data=dict(title='Princess Mononoke', year='1997'))
+        self.client.post('/movie/delete/3')
+        response = self.client.get('/search?q=mono', headers={'Accept': 'application/json'})
+        self.assertEqual(len(response.get_json()['results']), 1)
+        self.assertEqual(self.client.get('/search?q=toto&format=json').get_json()['results'], [])
+        self.assertEqual(self.client.get('/search?q=fire&format=json').get_json()['results'], [])
+
+    # 测试重建搜索索引
+    def test_reindex_command(self):
+        db.session.execute("INSERT INTO movie_fts(movie_fts) VALUES ('delete-all')")
+        db.session.commit()
+        self.assertEqual(self.client.get('/search?q=test&format=json').get_json()['results'], [])
+
+        result = self.runner.invoke(args=['reindex'])
+        self.assertIn('Reindexed 1 movies.', result.output)
+        results = self.client.get('/search?q=test&format=json').get_json()['results']
+        self.assertEqual(results[0]['title'], 'Test Movie Title')
+
+    # 测试 JSON 列表接口
+    def test_api_movies(self):
+        db.session.add_all([Movie(title='Movie %d' % i, year='2000', user_id=1) for i in range(2, 5)])
+        db.session.commit()
+        data = self.client.get('/api/movies?per_page=2').get_json()
+        self.assertEqual(data['total'], 4)
+        self.assertEqual([movie['id'] for movie in data['movies']], [1, 2])
+        self.assertEqual(data['next'], 2)
+        data = self.client.get('/api/movies?per_page=2&after=2').get_json()
+        self.assertEqual([movie['title'] for movie in data['movies']], ['Movie 3', 'Movie 4'])
+        self.assertIsNone(data['next'])
+
+    # 测试批量接口
+    def test_api_batch_movies(self):
+        payload = {
+            'create': [{'title': 'New Movie', 'year': 2019}, {'title': '', 'year': '2019'}],
+            'update': [{'id': 1, 'title': 'Edited', 'year': '2020'}, {'id': 99, 'title': 'Missing', 'year': '2020'}],
+            'delete': [99],
+        }
+        response = self.client.post('/api/movies/batch', json=payload)
+        self.assertEqual(response.status_code, 401)
+
+        self.login()
+        response = self.client.post('/api/movies/batch', json=payload)
+        data = response.get_json()
+        self.assertEqual(data['create'], [{'id': 2, 'ok': True}, {'ok': False, 'error': 'Invalid input.'}])
+        self.assertEqual(data['update'], [{'id': 1, 'ok': True}, {'id': 99, 'ok': False, 'error': 'Not found.'}])
+        self.assertEqual(data['delete'], [{'id': 99, 'ok': False, 'error': 'Not found.'}])
+        self.assertEqual(Movie.query.get(1).title, 'Edited')
+        self.assertEqual(Movie.query.get(2).year, 2019)
+
+        # 一批新增的电影只用一条 INSERT 语句
+        statements = self.record_sql()
+        response = self.client.post('/api/movies/batch', json={'create': [{'title': 'Movie %d' % i, 'year': 2000} for i in range(50)]})
+        self.assertEqual(len([sql for sql in statements if sql.startswith('INSERT INTO movie ')]), 1)
+        ids = [item['id'] for item in response.get_json()['create']]
+        self.assertEqual([Movie.query.get(movie_id).title for movie_id in (ids[0], ids[-1])], ['Movie 0', 'Movie 49'])
+        db.session.query(Movie).filter(Movie.id.in_(ids)).delete(synchronize_session=False)
+        db.session.commit()
+
+        # 布尔值和超出 64 位整数范围的数字不是电影 id
+        for bad_id in (True, 2 ** 63, -2 ** 63 - 1):
+            response = self.client.post('/api/movies/batch', json={'update': [{'id': bad_id, 'title': 'Bad', 'year': 2000}], 'delete': [bad_id]})
+            data = response.get_json()
+            self.assertEqual(data['update'], [{'id': bad_id, 'ok': False, 'error': 'Not found.'}])
+            self.assertEqual(data['delete'], [{'id': bad_id, 'ok': False, 'error': 'Not found.'}])
+        self.assertEqual(Movie.query.get(1).title, 'Edited')
+
+        response = self.client.post('/api/movies/batch', json={'delete': [1, 2]})
+        self.assertEqual(response.get_json()['delete'], [{'id': 1, 'ok': True}, {'id': 2, 'ok': True}])
+        self.assertEqual(Movie.query.count(), 0)
+
+        response = self.client.post('/api/movies/batch', data='not json')
+        self.assertEqual(response.status_code, 400)
+
+    # 测试导出
+    def test_export(self):
+        db.session.add(Movie(title='Leon, the Professional', year='1994', user_id=1))
+        db.session.commit()
+        app.config['EXPORT_CHUNK_SIZE'] = 1
+        self.addCleanup(app.config.__setitem__, 'EXPORT_CHUNK_SIZE', 1000)
+
+        response = self.client.get('/export')
+        self.assertEqual(response.mimetype, 'text/csv')
+        self.assertEqual(response.get_data(as_text=True),
+                         'id,title,year\n1,Test Movie Title,2019\n2,"Leon, the Professional",1994\n')
+
+        response = self.client.get('/export?format=ndjson')
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual(lines[1], '{"id": 2, "title": "Leon, the Professional", "year": 1994}')
+
+        self.assertEqual(self.client.get('/export?format=xml').status_code, 400)
+
+    # 测试导出命令
+    def test_export_command(self):
+        tmpdir = self.make_tmpdir()
+        path = os.path.join(tmpdir, 'movies.ndjson')
+        result = self.runner.invoke(args=['export', '--format', 'ndjson', '-o', path])
+        self.assertIn('Exported 1 movies.', result.output)
+        with open(path, encoding='utf-8') as f:
+            self.assertEqual(f.read(), '{"id": 1, "title": "Test Movie Title", "year": 2019}\n')
+
+    # 测试条件请求
+    def test_conditional_get(self):
+        response = self.client.get('/')
+        etag = response.headers['ETag']
+        last_modified = response.headers.get('Last-Modified')
+        self.assertTrue(etag.startswith('W/'))
+        self.assertIn('no-cache', response.headers['Cache-Control'])
+
+        statements = self.record_sql()
+
+        page_cache.clear()
+        response = self.client.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertFalse([sql for sql in statements if 'FROM movie' in sql])
+
+        # 修改之后版本号变化，旧的 ETag 失效
+        self.login()
+        self.client.post('/', data=dict(title='New Movie', year='2019'))
+        self.client.get('/logout', follow_redirects=True)
+        response = self.client.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('New Movie', response.get_data(as_text=True))
+        self.assertNotEqual(response.headers['ETag'], etag)
+        self.assertIsNone(last_modified)
+        self.assertIsNotNone(response.headers.get('Last-Modified'))
+
+        response = self.client.get('/', headers={'If-Modified-Since': response.headers['Last-Modified']})
+        self.assertEqual(response.status_code, 304)
+
+        # 导出和列表接口同样支持
+        response = self.client.get('/export')
+        response = self.client.get('/export', headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+        response = self.client.get('/api/movies')
+        response = self.client.get('/api/movies', headers={'If-None-Match': response.headers['ETag']})
+        self.assertEqual(response.status_code, 304)
+
+        # 部署新版本（代码或模板变化）后旧的 ETag 和缓存的页面同样失效
+        etag = self.client.get('/').headers['ETag']
+        with mock.patch.dict(app.extensions, {'source_version': 'deadbeef'}):
+            response = self.client.get('/', headers={'If-None-Match': etag})
+            self.assertEqual(response.status_code, 200)
+            self.assertNotEqual(response.headers['ETag'], etag)
+
+    # 测试静态文件构建
+    def test_assets_command(self):
+        dist = os.path.join(app.static_folder, 'dist')
+        self.assertFalse(os.path.exists(dist))
+        self.addCleanup(shutil.rmtree, dist)
+        etag = self.client.get('/').headers['ETag']
+        result = self.runner.invoke(args=['assets'])
+        self.assertIn('Built', result.output)
+
+        # 静态文件的文件名变了，旧的 ETag 失效
+        response = self.client.get('/', headers={'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        data = response.get_data(as_text=True)
+        match = re.search(r'href="(/static/dist/style\.\w+\.css)"', data)
+        self.assertIsNotNone(match)
+        self.assertIn('/static/dist/images/totoro.', data)
+
+        with open(os.path.join(app.static_folder, 'style.css'), 'rb') as f:
+            css = f.read()
+        response = self.client.get(match.group(1), headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(response.mimetype, 'text/css')
+        self.assertIn('immutable', response.headers['Cache-Control'])
+        self.assertEqual(gzip.decompress(response.get_data()), css)
+        response.close()
+
+        response = self.client.get(match.group(1))
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertEqual(response.get_data(), css)
+        response.close()
+
+    # 测试性能统计
+    def test_metrics(self):
+        self.client.get('/?per_page=3')
+        data = self.client.get('/metrics').get_data(as_text=True)
+        self.assertIn('watchlist_request_duration_seconds_bucket{endpoint="watchlist.index",le="+Inf"}', data)
+        self.assertIn('watchlist_request_duration_seconds_count{endpoint="watchlist.index"}', data)
+        match = re.search(r'watchlist_sql_queries_total\{endpoint="watchlist.index"\} (\d+)', data)
+        self.assertGreater(int(match.group(1)), 0)
+        self.assertIn('watchlist_template_render_seconds_total{endpoint="watchlist.index"}', data)
+        self.assertIn('watchlist_page_cache_misses_total', data)
+
+    # 测试组提交：同时到达的写操作在一个事务里提交，出错的操作不影响其他操作
+    def test_group_commit(self):
+        queue = WriteQueue(max_batch=3, max_wait=5)
+        results = {}
+
+        def add(title):
+            with app.app_context():
+                try:
+                    results[title] = write_watchlist(lambda: db.session.add(Movie(title=title, year=2000, user_id=1)))
+                except Exception as e:
+                    results[title] = e
+
+        def fail():
+            raise ValueError('bad write')
+
+        with mock.patch.dict(app.config, {'GROUP_COMMIT': True}), \
+                mock.patch.dict(app.extensions, {'write_queue': queue}):
+            threads = [threading.Thread(target=add, args=('Group %d' % i,)) for i in range(2)]
+            for thread in threads:
+                thread.start()
+            with self.assertRaises(ValueError):  # 第三个操作凑齐一批，不需要等待 max_wait
+                write_watchlist(fail)
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(results, {'Group 0': None, 'Group 1': None})
+        self.assertEqual(queue.batches, 1)
+        self.assertEqual(queue.writes, 3)
+        self.assertEqual(Movie.query.filter(Movie.title.like('Group %')).count(), 2)
+
+    # 测试开启组提交时的编辑和删除
+    def test_group_commit_views(self):
+        self.login()
+        with mock.patch.dict(app.config, {'GROUP_COMMIT': True}):
+            response = self.client.post('/movie/edit/1', data=dict(title='Grouped', year='2001'), follow_redirects=True)
+            self.assertIn('Item updated.', response.get_data(as_text=True))
+            self.assertEqual(Movie.query.get(1).title, 'Grouped')
+            response = self.client.post('/movie/delete/1', follow_redirects=True)
+            self.assertIn('Item deleted.', response.get_data(as_text=True))
+            self.assertIsNone(Movie.query.get(1))
+        self.assertEqual(app.extensions['write_queue'].writes, 2)
+        self.assertIn('watchlist_group_commit_batches_total', self.client.get('/metrics').get_data(as_text=True))
+
+    # 测试多个用户各自的电影列表
+    def test_multi_user(self):
+        result = self.runner.invoke(args=['adduser', '--username', 'other', '--password', '456'])
+        self.assertIn('Created user other.', result.output)
+        result = self.runner.invoke(args=['adduser', '--username', 'other', '--password', '456'])
+        self.assertNotEqual(result.exit_code, 0)
+        self.assertIn('User other already exists.', result.output)
+
+        self.client.post('/login', data=dict(username='other', password='456'))
+        data = self.client.get('/').get_data(as_text=True)
+        self.assertIn("other's Watchlist", data)
+        self.assertIn('0 Titles', data)
+        self.assertNotIn('Test Movie Title', data)
+        # 不能编辑和删除其他用户的电影
+        self.assertEqual(self.client.get('/movie/edit/1').status_code, 404)
+        self.assertEqual(self.client.post('/movie/delete/1').status_code, 404)
+        self.assertEqual(Movie.query.get(1).title, 'Test Movie Title')
+
+        self.client.post('/', data=dict(title='Other Movie', year='2001'))
+        data = self.client.get('/').get_data(as_text=True)
+        self.assertIn('1 Titles', data)
+        self.assertIn('Other Movie', data)
+        self.assertEqual(self.client.get('/search?q=movie&format=json').get_json()['results'][0]['title'], 'Other Movie')
+        self.assertEqual(self.client.get('/stats?format=json').get_json()['years'], [{'year': 2001, 'count': 1}])
+
+        # 未登录的访客看到站点所有者（第一个用户）的电影列表
+        self.client.get('/logout')
+        data = self.client.get('/').get_data(as_text=True)
+        self.assertIn("Test's Watchlist", data)
+        self.assertIn('Test Movie Title', data)
+        self.assertNotIn('Other Movie', data)
+
+    # 测试按用户分页使用 (user_id, id) 索引，只读取这个用户的记录
+    def test_movie_owner_index(self):
+        plan = db.session.execute(
+            'EXPLAIN QUERY PLAN SELECT id FROM movie WHERE user_id = 1 AND id > 10 ORDER BY id LIMIT 20'
+        ).fetchall()
+        self.assertIn('ix_movie_user_id_id', ' '.join(row[-1] for row in plan))
+
+    # 测试按年份统计随添加、编辑、删除同步更新
+    def test_stats(self):
+        self.login()
+        self.client.post('/', data=dict(title='New Movie', year='2011'))
+        self.client.post('/', data=dict(title='Old Movie', year='1999'))
+        self.client.post('/movie/edit/1', data=dict(title='Test Movie Title', year='2015'))
+        data = self.client.get('/stats?format=json').get_json()
+        self.assertEqual(data['total'], 3)
+        self.assertEqual(data['years'], [{'year': 1999, 'count': 1}, {'year': 2011, 'count': 1}, {'year': 2015, 'count': 1}])
+        self.assertEqual(data['decades'], [{'decade': 1990, 'count': 1}, {'decade': 2010, 'count': 2}])
+
+        self.client.post('/movie/delete/1')
+        data = self.client.get('/stats?format=json').get_json()
+        self.assertEqual(data['total'], 2)
+        self.assertEqual(data['decades'], [{'decade': 1990, 'count': 1}, {'decade': 2010, 'count': 1}])
+
+        response = self.client.get('/stats')
+        self.assertIn('2 Titles', response.get_data(as_text=True))
+        self.assertIn('1990s', response.get_data(as_text=True))
+
+    # 测试重新计算统计
+    def test_rebuild_stats_command(self):
+        db.session.execute('DELETE FROM movie_year_stat')
+        db.session.commit()
+        self.assertEqual(movie_stats(1)['total'], 0)
+        result = self.runner.invoke(args=['rebuild-stats'])
+        self.assertIn('Counted 1 movies.', result.output)
+        self.assertEqual(movie_stats(1)['years'], [(2019, 1)])
+
+    # 测试 IMDb 标题索引
+    def test_imdb_index(self):
+        tmpdir = self.make_tmpdir()
+        tsv = os.path.join(tmpdir, 'title.basics.tsv.gz')
+        with gzip.open(tsv, 'wt', encoding='utf-8') as f:
+            f.write('tconst\ttitleType\tprimaryTitle\toriginalTitle\tisAdult\tstartYear\tendYear\truntimeMinutes\tgenres\n')
+            f.write('tt0110413\tmovie\tLéon: The Professional\tLéon\t0\t1994\t\\N\t110\tAction,Crime,Drama\n')
+            f.write('tt0000001\ttvEpisode\tWALL-E\tWALL-E\t0\t2008\t\\N\t5\tComedy\n')
+            f.write('tt0910970\tmovie\tWALL·E\tWALL·E\t0\t2008\t\\N\t98\tAnimation,Family\n')
+            f.write('tt9999999\tvideo\tWall E\tWall E\t0\t2008\t\\N\t\\N\t\\N\n')
+            f.write('tt0096283\tmovie\tMy Neighbor Totoro\tTonari no Totoro\t0\t1988\t\\N\t86\t\\N\n')
+            f.write('tt0000002\tmovie\tNo Year\tNo Year\t0\t\\N\t\\N\t90\tDrama\n')
+        path = os.path.join(tmpdir, 'imdb.idx')
+        result = self.runner.invoke(args=['imdb-index', tsv, '--output', path, '--run-size', '2'])
+        self.assertIn('Indexed 5 titles', result.output)  # 原名不同时两个标题都收录，同名同年的只保留一个
+
+        index = ImdbIndex(path)
+        self.assertEqual(index.lookup('leon', 1994), {'imdb_id': 'tt0110413', 'runtime': 110, 'genres': 'Action,Crime,Drama'})
+        self.assertEqual(index.lookup('Leon the Professional', '1994')['imdb_id'], 'tt0110413')
+        self.assertEqual(index.lookup('WALL E', 2008)['imdb_id'], 'tt0910970')  # 同名同年时优先电影，不收录单集
+        self.assertEqual(index.lookup('Tonari no Totoro', 1988), {'imdb_id': 'tt0096283', 'runtime': 86, 'genres': None})
+        self.assertIsNone(index.lookup('Leon', 1995))
+        self.assertIsNone(index.lookup('No Year', 2000))
+
+        # 添加和编辑电影时填写 IMDb 信息
+        self.login()
+        with mock.patch.dict(app.extensions, {'imdb_index': index}):
+            self.client.post('/', data=dict(title='Leon', year='1994'))
+            movie = Movie.query.filter_by(title='Leon').one()
+            self.assertEqual((movie.imdb_id, movie.runtime, movie.genres), ('tt0110413', 110, 'Action,Crime,Drama'))
+            movie_id = movie.id
+            data = self.client.get('/').get_data(as_text=True)
+            self.assertIn('https://www.imdb.com/title/tt0110413/', data)
+            self.assertIn('110 min · Action, Crime, Drama', data)
+
+            # 批量接口和导入同样填写，改名后找不到时清空
+            response = self.client.post('/api/movies/batch', json={'create': [{'title': 'WALL-E', 'year': 2008}]})
+            created = response.get_json()['create'][0]['id']
+            self.assertEqual(Movie.query.get(created).imdb_id, 'tt0910970')
+            self.client.post('/api/movies/batch', json={'update': [{'id': created, 'title': 'Totally Different', 'year': 2008}]})
+            db.session.expire_all()
+            self.assertIsNone(Movie.query.get(created).imdb_id)
+            jsonl = os.path.join(tmpdir, 'movies.jsonl')
+            with open(jsonl, 'w', encoding='utf-8') as f:
+                f.write('{"title": "My Neighbor Totoro", "year": 1988}\n')
+            self.runner.invoke(args=['import', jsonl])
+            self.assertEqual(Movie.query.filter_by(title='My Neighbor Totoro').one().runtime, 86)
+
+            self.client.post('/movie/edit/%d' % movie_id, data=dict(title='Leon', year='1995'))
+            movie = Movie.query.get(movie_id)
+            self.assertEqual((movie.imdb_id, movie.runtime, movie.genres), (None, None, None))
+
+        # 没有可用的索引（未设置、文件不存在、空文件）时编辑不会清空已有的信息
+        movie = Movie.query.get(movie_id)
+        movie.imdb_id = 'tt0110413'
+        db.session.commit()
+        empty = os.path.join(tmpdir, 'empty.idx')
+        open(empty, 'wb').close()
+        for index in (ImdbIndex(''), ImdbIndex(os.path.join(tmpdir, 'missing.idx')), ImdbIndex(empty)):
+            self.assertFalse(index.loaded)
+            self.assertIsNone(index.lookup('Leon', 1994))
+            with mock.patch.dict(app.extensions, {'imdb_index': index}):
+                response = self.client.post('/movie/edit/%d' % movie.id, data=dict(title='Leon', year='1996'))
+                self.assertEqual(response.status_code, 302)
+            self.assertEqual(Movie.query.get(movie.id).imdb_id, 'tt0110413')
+
+    # 测试后台导入、导出和重建索引任务
+    def test_jobs(self):
+        tmpdir = self.make_tmpdir()
+        self.addCleanup(app.config.__setitem__, 'JOB_DIR', app.config['JOB_DIR'])
+        app.config['JOB_DIR'] = tmpdir
+        runner = app.extensions['job_runner']
+
+        response = self.client.post('/api/jobs/export')
+        self.assertEqual(response.status_code, 401)
+        self.login()
+
+        response = self.client.post('/api/jobs/import?format=csv', data='title,year\nJob Movie,2003\nBad,abc\n',
+                                    content_type='text/csv')
+        self.assertEqual(response.status_code, 202)
+        self.assertEqual(response.get_json()['status'], 'queued')
+        url = response.headers['Location']
+        runner.join()
+        data = self.client.get(url).get_json()
+        self.assertEqual(data['status'], 'succeeded')
+        self.assertEqual(data['progress'], 2)
+        self.assertEqual(data['result'], {'imported': 1, 'rejected': 1})
+        self.assertEqual(Movie.query.filter_by(title='Job Movie', user_id=1).count(), 1)
+        self.assertEqual(os.listdir(tmpdir), [])  # 上传的文件已经删除
+
+        response = self.client.post('/api/jobs/export?format=csv')
+        runner.join()
+        data = self.client.get(response.headers['Location']).get_json()
+        self.assertEqual(data['status'], 'succeeded')
+        self.assertEqual((data['progress'], data['total']), (2, 2))
+        self.assertEqual(data['result'], {'exported': 2, 'format': 'csv'})
+        response = self.client.get(data['download'])
+        self.assertEqual(response.get_data(as_text=True), 'id,title,year\n1,Test Movie Title,2019\n2,Job Movie,2003\n')
+        self.assertIn('attachment; filename=movies.csv', response.headers['Content-Disposition'])
+        response.close()
+
+        response = self.client.post('/api/jobs/reindex')
+        runner.join()
+        data = self.client.get(response.headers['Location']).get_json()
+        self.assertEqual((data['status'], data['result']), ('succeeded', {'movies': 2}))
+        self.assertEqual(len(self.client.get('/api/jobs').get_json()['jobs']), 3)
+        self.assertEqual(self.client.post('/api/jobs/unknown').status_code, 404)
+
+    # 测试进程重启后遗留的任务、上传大小限制和导出文件的清理
+    def test_job_recovery_and_cleanup(self):
+        tmpdir = self.make_tmpdir()
+        self.addCleanup(app.config.__setitem__, 'JOB_DIR', app.config['JOB_DIR'])
+        app.config['JOB_DIR'] = tmpdir
+        runner = JobRunner()
+        self.login()
+
+        upload = os.path.join(tmpdir, 'upload-old.csv')
+        open(upload, 'w').close()
+        jobs = [
+            Job(kind='reindex', status='running', user_id=1),  # 升级前提交的任务，没有记录进程
+            Job(kind='import', status='queued', user_id=1, worker=current_worker(), params=json.dumps({'path': upload})),
+            Job(kind='reindex', status='running', user_id=1, worker=current_worker(), cancel_requested=True),
+            Job(kind='reindex', status='running', user_id=1, worker='other-host:1'),  # 其他主机上的进程，无法判断
+        ]
+        db.session.add_all(jobs)
+        db.session.commit()
+        ids = [job.id for job in jobs]
+        with mock.patch.dict(app.extensions, {'job_runner': runner}):
+            statuses = {job['id']: job['status'] for job in self.client.get('/api/jobs').get_json()['jobs']}
+            self.assertEqual([statuses[job_id] for job_id in ids], ['failed', 'failed', 'cancelled', 'running'])
+            self.assertFalse(os.path.exists(upload))
+            self.assertEqual(self.client.post('/api/jobs/%d/cancel' % ids[0]).status_code, 409)
+            self.assertEqual(runner.recover(), 0)  # 每个进程只处理一次
+
+            # 上传的文件超过 MAX_CONTENT_LENGTH
+            with mock.patch.dict(app.config, {'MAX_CONTENT_LENGTH': 10}):
+                response = self.client.post('/api/jobs/import?format=csv', data='title,year\nToo Large,2003\n',
+                                            content_type='text/csv')
+                self.assertEqual(response.status_code, 413)
+                response = self.client.post('/api/jobs/import?format=csv', content_type='multipart/form-data',
+                                            data={'file': (io.BytesIO(b'title,year\nToo Large,2003\n'), 'movies.csv')})
+                self.assertEqual(response.status_code, 413)
+            self.assertEqual(os.listdir(tmpdir), [])
+
+            # 超过 JOB_FILE_TTL 的导出文件在下一次提交任务时删除
+            response = self.client.post('/api/jobs/export?format=csv')
+            runner.join()
+            data = self.client.get(response.headers['Location']).get_json()
+            path = os.path.join(tmpdir, 'export-%d.csv' % data['id'])
+            self.assertTrue(os.path.exists(path))
+            os.utime(path, (time.time() - app.config['JOB_FILE_TTL'] - 1,) * 2)
+            self.client.post('/api/jobs/export?format=csv')
+            runner.join()
+            self.assertFalse(os.path.exists(path))
+            data = self.client.get(data['url']).get_json()
+            self.assertNotIn('download', data)
+            self.assertEqual(self.client.get(data['url'] + '/download').status_code, 404)
+
+    # 测试任务数量上限和取消任务
+    def test_job_cancel(self):
+        tmpdir = self.make_tmpdir()
+        # 任务在其他线程中执行，使用数据库文件（内存型数据库的所有线程共用一个连接）
+        other = self.file_app(os.path.join(tmpdir, 'data.db'), JOB_DIR=tmpdir, JOB_WORKERS=1, JOB_QUEUE_SIZE=1)
+        client = other.test_client()
+        client.post('/login', data=dict(username='test', password='123'))
+
+        started = threading.Event()
+
+        def wait_for_cancel(job):
+            started.set()
+            while True:  # 直到被取消
+                job.progress(message='Waiting.')
+                time.sleep(0.01)
+
+        with mock.patch.dict(JOB_KINDS, {'reindex': (wait_for_cancel, False)}):
+            running = client.post('/api/jobs/reindex').get_json()
+            self.assertTrue(started.wait(5))
+            queued = client.post('/api/jobs/reindex').get_json()
+            response = client.post('/api/jobs/reindex')  # 正在执行一个，排队一个，已经满了
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.headers['Retry-After'], '10')
+
+            data = client.post(queued['url'] + '/cancel').get_json()
+            self.assertEqual(data['status'], 'cancelled')
+            data = client.post(running['url'] + '/cancel').get_json()
+            self.assertTrue(data['cancel_requested'])
+            other.extensions['job_runner'].join(5)
+        self.assertEqual(client.get(running['url']).get_json()['status'], 'cancelled')
+        self.assertEqual(client.post(running['url'] + '/cancel').status_code, 409)
+
+    # 测试慢请求日志
+    def test_slow_request_log(self):
+        app.config['SLOW_REQUEST_THRESHOLD'] = 0.0
+        self.addCleanup(app.config.__setitem__, 'SLOW_REQUEST_THRESHOLD', None)
+        with self.assertLogs(app.logger, 'WARNING') as logs:
+            self.client.get('/?per_page=3')
+        self.assertIn('Slow request GET /?per_page=3 (watchlist.index)', logs.output[0])
+        self.assertIn('FROM movie', logs.output[0])
+
     # 辅助方法，用于登入用户
     def login(self):
         self.client.post('/login', data=dict(
@@ -64,6 +884,40 @@ class WatchlistTestCase(unittest.TestCase):
             password='123'
         ), follow_redirects=True)
 
+    # 创建临时目录，测试结束后删除
+    def make_tmpdir(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        return tmpdir
+
+    # 记录之后执行的 SQL 语句，返回保存语句的列表
+    def record_sql(self):
+        statements = []
+        def record(conn, cursor, statement, *args):
+            statements.append(statement)
+        event.listen(db.engine, 'before_cursor_execute', record)
+        self.addCleanup(event.remove, db.engine, 'before_cursor_execute', record)
+        return statements
+
+    # 创建使用 SQLite 数据库文件的程序实例（内存型数据库不能在多个程序实例或线程之间共用），
+    # path 默认是临时目录中的 data.db；create 为 True 时创建数据库表和测试用户
+    def file_app(self, path=None, create=True, **config):
+        if path is None:
+            path = os.path.join(self.make_tmpdir(), 'data.db')
+        config.setdefault('SQLALCHEMY_DATABASE_URI', 'sqlite:///' + path)
+        other = create_app(config)
+        self.addCleanup(lambda: db.get_engine(other).dispose())
+        db.session.remove()  # 数据库会话按线程共用，换到另一个程序实例前先关闭
+        if create:
+            with other.app_context():
+                db.create_all()
+                user = User(name='Test', username='test')
+                user.set_password('123')
+                db.session.add(user)
+                db.session.commit()
+                db.session.remove()
+        return other
+
     # 测试创建条目
     def test_create_item(self):
         self.login()
@@ -203,6 +1057,89 @@ class WatchlistTestCase(unittest.TestCase):
         self.assertNotIn('Login success.', data)
         self.assertIn('Invalid input.', data)
 
+    # 测试登录时升级密码散列值
+    def test_login_rehash(self):
+        user = User.query.first()
+        user.password_hash = generate_password_hash('123', method='pbkdf2:sha256:1000')
+        db.session.commit()
+        self.assertTrue(user.needs_rehash())
+
+        self.login()
+        user = User.query.first()
+        self.assertTrue(user.password_hash.startswith(app.config['PASSWORD_HASH_METHOD'] + '$'))
+        self.assertFalse(user.needs_rehash())
+        self.assertTrue(user.validate_password('123'))
+
+    # 测试登录请求过多时返回 503
+    def test_login_overloaded(self):
+        hasher = PasswordHasher(workers=1, queue_size=0)
+        with mock.patch.dict(app.extensions, {'password_hasher': hasher}):
+            hasher._slots.acquire()  # 占用唯一的计算槽位
+            response = self.client.post('/login', data=dict(username='test', password='123'))
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.headers['Retry-After'], '1')
+
+            hasher._slots.release()
+            response = self.client.post('/login', data=dict(username='test', password='123'), follow_redirects=True)
+            self.assertIn('Login success.', response.get_data(as_text=True))
+
+    # 测试按客户端限速
+    def test_rate_limit(self):
+        limits = dict(app.config['RATE_LIMITS'], **{'watchlist.login': (0.5, 2)})
+        with mock.patch.dict(app.config, {'RATE_LIMITS': limits, 'TRUSTED_PROXIES': 0}):
+            for _ in range(2):
+                self.client.post('/login', data=dict(username='test', password='456'))
+            response = self.client.post('/login', data=dict(username='test', password='123'))
+            self.assertEqual(response.status_code, 429)
+            self.assertEqual(response.headers['Retry-After'], '2')
+            self.assertIn('watchlist_admission_rejected_total{reason="rate"} 1', self.client.get('/metrics').get_data(as_text=True))
+
+            # 其他视图和其他地址分别计数
+            self.assertEqual(self.client.get('/').status_code, 200)
+            response = self.client.post('/login', data=dict(username='test', password='123'),
+                                        environ_base={'REMOTE_ADDR': '10.0.0.2'})
+            self.assertEqual(response.status_code, 302)
+
+            with mock.patch.dict(app.config, {'ADMISSION_CONTROL': False}):
+                self.assertEqual(self.client.post('/login', data=dict(username='test', password='123')).status_code, 302)
+
+            # 没有设置 TRUSTED_PROXIES 时不按客户端限速
+            with mock.patch.dict(app.config, {'TRUSTED_PROXIES': None}):
+                self.assertEqual(self.client.post('/login', data=dict(username='test', password='123')).status_code, 302)
+
+    # 测试部署在代理后面时按客户端的真实地址限速
+    def test_rate_limit_trusted_proxy(self):
+        limits = {'default': (0.01, 1)}
+        for proxies, expected in ((0, 429), (1, 200)):
+            other = create_app({'TRUSTED_PROXIES': proxies, 'RATE_LIMITS': limits})
+            client = other.test_client()
+            self.assertEqual(client.get('/user/a', headers={'X-Forwarded-For': '10.0.0.1'}).status_code, 200)
+            response = client.get('/user/a', headers={'X-Forwarded-For': '10.0.0.2'})
+            self.assertEqual(response.status_code, expected)
+
+    # 测试视图的并发上限
+    def test_concurrency_limit(self):
+        with mock.patch.dict(app.config, {'CONCURRENCY_LIMITS': {'watchlist.search': 1}, 'CONCURRENCY_QUEUE': 1,
+                                          'CONCURRENCY_TIMEOUT': 0.05}):
+            self.assertEqual(self.client.get('/search?q=test').status_code, 200)
+
+            # 占用唯一的槽位后，排队的请求等待超时返回 503
+            slot = app.extensions['concurrency_limiter']._slots[('watchlist.search', 1)]
+            slot[0].acquire()
+            response = self.client.get('/search?q=test')
+            self.assertEqual(response.status_code, 503)
+            self.assertEqual(response.headers['Retry-After'], '1')
+
+            # 队列已满时不等待
+            slot[1] = 1
+            start = time.perf_counter()
+            self.assertEqual(self.client.get('/search?q=test').status_code, 503)
+            self.assertLess(time.perf_counter() - start, 0.05)
+            slot[1] = 0
+            slot[0].release()
+            self.assertEqual(self.client.get('/search?q=test').status_code, 200)
+            self.assertEqual(self.client.get('/').status_code, 200)  # 未设置上限的视图不受影响
+
     # 测试登出
     def test_logout(self):
         self.login()
@@ -253,6 +1190,41 @@ class WatchlistTestCase(unittest.TestCase):
         result = self.runner.invoke(initdb)
         self.assertIn('Initialized database.', result.output)
 
+    # 测试批量导入 CSV
+    def test_import_command_csv(self):
+        tmpdir = self.make_tmpdir()
+        path = os.path.join(tmpdir, 'movies.csv')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('title,year\n')
+            f.write('Spirited Away,2001\n')
+            f.write('Ponyo,2008\n')
+            f.write(',2010\n')  # 标题为空
+            f.write('Too Long Year,20100\n')  # 年份过长
+            f.write('Not A Year,abcd\n')  # 年份不是数字
+        result = self.runner.invoke(args=['import', path, '--batch-size', '1'])
+        self.assertIn('Imported 2 movies, rejected 3 rows', result.output)
+        self.assertEqual(Movie.query.count(), 3)
+        self.assertEqual(Movie.query.filter_by(title='Ponyo').first().year, 2008)
+
+    # 测试批量导入 JSONL
+    def test_import_command_jsonl(self):
+        tmpdir = self.make_tmpdir()
+        path = os.path.join(tmpdir, 'movies.jsonl')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('{"title": "Spirited Away", "year": 2001}\n')
+            f.write('\n')
+            f.write('not json\n')
+            f.write('{"title": "%s", "year": "2001"}\n' % ('x' * 61))
+            # 字段类型不对的行也只是拒绝，不会中断导入
+            f.write('{"title": 123, "year": 1999}\n')
+            f.write('{"title": ["a", "b"], "year": 1999}\n')
+            f.write('{"title": "Bad Year", "year": [1999]}\n')
+            f.write('{"title": "Howl\'s Moving Castle", "year": "2004"}\n')
+        result = self.runner.invoke(args=['import', path, '--batch-size', '1'])
+        self.assertIn('Imported 2 movies, rejected 5 rows', result.output)
+        self.assertEqual(Movie.query.filter_by(title='Spirited Away').first().year, 2001)
+        self.assertEqual(Movie.query.filter_by(title='Howl\'s Moving Castle').first().year, 2004)
+
     # 测试生成管理员账户
     def test_admin_command(self):
         db.drop_all()